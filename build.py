@@ -1,14 +1,29 @@
 import argparse
+import functools
+import hashlib
 import json
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
-from datetime import datetime
+from datetime import datetime, timezone
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 logger = logging.getLogger(__name__)
-sm_client = boto3.client("sagemaker")
+sm_client_config = Config(
+    max_pool_connections=20,
+    retries={"mode": "adaptive", "max_attempts": 10},
+    tcp_keepalive=True,
+    user_agent_extra="churn-monitor-build",
+)
+sm_client = boto3.Session().client("sagemaker", config=sm_client_config)
 
 
 def get_approved_package(model_package_group_name):
@@ -21,37 +36,28 @@ def get_approved_package(model_package_group_name):
         The SageMaker Model Package ARN.
     """
     try:
-        # Get the latest approved model package
-        response = sm_client.list_model_packages(
+        # Get the latest approved model package, stopping at the first item found
+        paginator = sm_client.get_paginator("list_model_packages")
+        page_iterator = paginator.paginate(
             ModelPackageGroupName=model_package_group_name,
             ModelApprovalStatus="Approved",
             SortBy="CreationTime",
-            MaxResults=100,
+            SortOrder="Descending",
+            PaginationConfig={"MaxItems": 1, "PageSize": 50},
+        )
+        model_package_arn = next(
+            page_iterator.search("ModelPackageSummaryList[].ModelPackageArn"), None
         )
-        approved_packages = response["ModelPackageSummaryList"]
-
-        # Fetch more packages if none returned with continuation token
-        while len(approved_packages) == 0 and "NextToken" in response:
-            logger.debug("Getting more packages for token: {}".format(response["NextToken"]))
-            response = sm_client.list_model_packages(
-                ModelPackageGroupName=model_package_group_name,
-                ModelApprovalStatus="Approved",
-                SortBy="CreationTime",
-                MaxResults=100,
-                NextToken=response["NextToken"],
-            )
-            approved_packages.extend(response["ModelPackageSummaryList"])
 
         # Return error if no packages found
-        if len(approved_packages) == 0:
+        if model_package_arn is None:
             error_message = (
                 f"No approved ModelPackage found for ModelPackageGroup: {model_package_group_name}"
             )
             logger.error(error_message)
             raise Exception(error_message)
 
-        # Return the pmodel package arn
-        model_package_arn = approved_packages[0]["ModelPackageArn"]
+        # Return the model package arn
         logger.info(f"Identified the latest approved model package: {model_package_arn}")
         return model_package_arn
     except ClientError as e:
@@ -86,37 +92,60 @@ def get_previous_model_name(project_name, endpoint_name):
         raise
 
 
-def extend_config(args, model_package_arn, stage_config):
+def get_unique_resource_name(prefix, timestamp, max_length=63):
+    """Builds a SageMaker resource name from a prefix and timestamp within max_length.
+
+    When the name would be too long, the prefix is truncated and a hash of the full
+    prefix is kept so names from different prefixes do not collide.
+    """
+    name = f"{prefix}{timestamp}"
+    if len(name) > max_length:
+        suffix = hashlib.blake2b(prefix.encode(), digest_size=4).hexdigest() + timestamp
+        name = prefix[: max_length - len(suffix)] + suffix
+    return name[:max_length]
+
+
+def extend_config(args, model_package_arn, stage_config, timestamp=None):
     """
     Extend the stage configuration with additional parameters and tags based.
     """
     # Verify that config has parameters and tags sections
-    if "Parameters" not in stage_config or "StageName" not in stage_config["Parameters"]:
-        raise Exception("Configuration file must include SageName parameter")
+    params = stage_config.get("Parameters")
+    if params is None or "StageName" not in params:
+        raise Exception("Configuration file must include StageName parameter")
     if "Tags" not in stage_config:
         stage_config["Tags"] = {}
 
     # Set model, endpoint configuration and endpoint names
-    stage_name = stage_config['Parameters']['StageName']
-    timestamp = datetime.utcnow().strftime("%Y%m%d%H%M%S")
-
-    candidate_model_name = f"Model-{args.sagemaker_project_name}-{stage_name}-{args.deployment_strategy}-{timestamp}"[:63]
-    endpoint_config_name = f"EndpointConfig-{args.sagemaker_project_name}-{stage_name}-{timestamp}"[:63]
+    stage_name = params["StageName"]
+    if timestamp is None:
+        timestamp = datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S")
+
+    candidate_model_name = get_unique_resource_name(
+        f"Model-{args.sagemaker_project_name}-{stage_name}-{args.deployment_strategy}-", timestamp
+    )
+    endpoint_config_name = get_unique_resource_name(
+        f"EndpointConfig-{args.sagemaker_project_name}-{stage_name}-", timestamp
+    )
     endpoint_name = f"Endpoint-{args.sagemaker_project_name}-{stage_name}"
 
-    # Get previous deployed model if exists
-    previous_prod_model_name = get_previous_model_name(args.sagemaker_project_name, endpoint_name)
+    # Get previous deployed model if exists, not needed for a first deployment
+    previous_prod_model_name = (
+        ""
+        if args.deployment_strategy == "first"
+        else get_previous_model_name(args.sagemaker_project_name, endpoint_name)
+    )
     if args.deployment_strategy not in ["first"] and not previous_prod_model_name:
         raise Exception(
-            f"{args.deployment_strategy} requires an existing endpoint"
-            f"Stage = {stage_config['Parameters']['StageName']}: No endpoint found."
+            f"{args.deployment_strategy} requires an existing endpoint. "
+            f"Stage = {stage_name}: No endpoint found."
         )
 
     # Create new params and tags
     new_params = {
         # General parameters
         "SageMakerProjectName": args.sagemaker_project_name,
-        "DataCaptureUploadPath": "s3://" + args.s3_bucket + '/datacapture-' + stage_config["Parameters"]["StageName"],
+        "DataCaptureUploadPath": f"s3://{args.s3_bucket}/datacapture-{stage_name}",
 
         # Candidate model identifiers
         "ModelPackageName": model_package_arn,
@@ -142,62 +171,89 @@ def extend_config(args, model_package_arn, stage_config):
         new_params["CandidateModelWeight"] = str(args.candidate_weight)
 
     new_tags = {
-        "sagemaker:deployment-stage": stage_config["Parameters"]["StageName"],
+        "sagemaker:deployment-stage": stage_name,
         "sagemaker:project-id": args.sagemaker_project_id,
         "sagemaker:project-name": args.sagemaker_project_name,
         "sagemaker:deployment-strategy": args.deployment_strategy
     }
 
-    # Add tags from Project
-    get_pipeline_custom_tags(args, sm_client, new_tags)
-
     return {
-        "Parameters": {**stage_config["Parameters"], **new_params},
-        "Tags": {**stage_config.get("Tags", {}), **new_tags},
+        "Parameters": params | new_params,
+        "Tags": (stage_config.get("Tags") or {}) | new_tags,
     }
 
 
-def get_pipeline_custom_tags(args, sm_client, new_tags):
+@functools.lru_cache(maxsize=4)
+def _fetch_project_tags(project_name):
+    # Describe the project and list its tags once per project name
+    response = sm_client.describe_project(ProjectName=project_name)
+    sagemaker_project_arn = response["ProjectArn"]
+    response = sm_client.list_tags(ResourceArn=sagemaker_project_arn)
+    return {project_tag["Key"]: project_tag["Value"] for project_tag in response["Tags"]}
+
+
+def get_pipeline_custom_tags(args):
+    project_tags = {}
     try:
-        response = sm_client.describe_project(
-            ProjectName=args.sagemaker_project_name
-        )
-        sagemaker_project_arn = response["ProjectArn"]
-        response = sm_client.list_tags(
-                ResourceArn=sagemaker_project_arn)
-        project_tags = response["Tags"]
-        for project_tag in project_tags:
-            new_tags[project_tag["Key"]] = project_tag["Value"]
-    except:
-        logger.error("Error getting project tags")
-    return new_tags
+        project_tags.update(_fetch_project_tags(args.sagemaker_project_name))
+    except ClientError as e:
+        error_code = e.response["Error"]["Code"]
+        logger.error(f"Error getting project tags: {error_code}")
+    return project_tags
 
 
 def get_cfn_style_config(stage_config):
-    parameters = []
-    for key, value in stage_config["Parameters"].items():
-        parameter = {
-            "ParameterKey": key,
-            "ParameterValue": value
-        }
-        parameters.append(parameter)
-    tags = []
-    for key, value in stage_config["Tags"].items():
-        tag = {
-            "Key": key,
-            "Value": value
-        }
-        tags.append(tag)
+    # CloudFormation expects string parameter values
+    parameters = [
+        {"ParameterKey": key, "ParameterValue": str(value)}
+        for key, value in stage_config["Parameters"].items()
+    ]
+    tags = [
+        {"Key": key, "Value": value}
+        for key, value in stage_config["Tags"].items()
+    ]
     return parameters, tags
 
 
+def _load(path):
+    # Read a JSON file, using orjson when available
+    if orjson is not None:
+        with open(path, "rb") as f:
+            return orjson.loads(f.read())
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def _write_if_changed(path, payload):
+    # Skip the write when the file already holds the same bytes. Only the tags files
+    # can match on a re-run, the config and params files embed the build timestamp
+    # in CandidateModelName and EndpointConfigName and so change on every run.
+    try:
+        with open(path, "rb") as f:
+            if f.read() == payload:
+                logger.debug(f"Unchanged, skipping write: {path}")
+                return False
+    except FileNotFoundError:
+        pass
+    with open(path, "wb") as f:
+        f.write(payload)
+    return True
+
+
+def _dump(obj, path):
+    # Write a JSON file, using orjson when available
+    if orjson is not None:
+        payload = orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+    else:
+        payload = json.dumps(obj, indent=2, ensure_ascii=False).encode("utf-8")
+    return _write_if_changed(path, payload)
+
+
 def create_cfn_params_tags_file(config, export_params_file, export_tags_file):
     # Write Params and tags in separate file for Cfn cli command
     parameters, tags = get_cfn_style_config(config)
-    with open(export_params_file, "w") as f:
-        json.dump(parameters, f, indent=4)
-    with open(export_tags_file, "w") as f:
-        json.dump(tags, f, indent=4)
+    _dump(parameters, export_params_file)
+    _dump(tags, export_tags_file)
 
 
 if __name__ == "__main__":
@@ -230,22 +286,38 @@ if __name__ == "__main__":
     model_package_arn = get_approved_package(args.model_package_group_name)
     logger.info(f"Latest approved model package ARN: {model_package_arn}")
 
+    # Extend the staging and prod configs concurrently with a shared build timestamp,
+    # while the project tags are fetched once for both stages
+    run_ts = datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S")
+    import_staging_config = _load(args.import_staging_config)
+    import_prod_config = _load(args.import_prod_config)
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        project_tags_future = executor.submit(get_pipeline_custom_tags, args)
+        staging_future = executor.submit(
+            extend_config, args, model_package_arn, import_staging_config, timestamp=run_ts
+        )
+        prod_future = executor.submit(
+            extend_config, args, model_package_arn, import_prod_config, timestamp=run_ts
+        )
+        staging_config, prod_config = staging_future.result(), prod_future.result()
+        project_tags = project_tags_future.result()
+
+    # Add tags from Project, these take precedence over stage and deployment tags
+    staging_config["Tags"].update(project_tags)
+    prod_config["Tags"].update(project_tags)
+
     # Write the staging config
-    with open(args.import_staging_config, "r") as f:
-        staging_config = extend_config(args, model_package_arn, json.load(f))
-    logger.debug("Staging config: {}".format(json.dumps(staging_config, indent=4)))
-    with open(args.export_staging_config, "w") as f:
-        json.dump(staging_config, f, indent=4)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Staging config: %s", json.dumps(staging_config, indent=4))
+    _dump(staging_config, args.export_staging_config)
     if (args.export_cfn_params_tags):
         create_cfn_params_tags_file(staging_config, args.export_staging_params, args.export_staging_tags)
     logger.info(f"Exported staging config with deployment strategy: {args.deployment_strategy}")
 
     # Write the prod config for code pipeline
-    with open(args.import_prod_config, "r") as f:
-        prod_config = extend_config(args, model_package_arn, json.load(f))
-    logger.debug("Prod config: {}".format(json.dumps(prod_config, indent=4)))
-    with open(args.export_prod_config, "w") as f:
-        json.dump(prod_config, f, indent=4)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Prod config: %s", json.dumps(prod_config, indent=4))
+    _dump(prod_config, args.export_prod_config)
     if (args.export_cfn_params_tags):
         create_cfn_params_tags_file(prod_config, args.export_prod_params, args.export_prod_tags)
     logger.info(f"Exported production config with deployment strategy: {args.deployment_strategy}")
@@ -4,10 +4,13 @@ import logging
 import os
 
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
 logger = logging.getLogger(__name__)
-sm_client = boto3.client("sagemaker")
+sm_client = boto3.client(
+    "sagemaker", config=Config(retries={"mode": "adaptive", "max_attempts": 10})
+)
 
 
 def invoke_endpoint(endpoint_name):